@@ -5,14 +5,11 @@ import errno
 import re
 import sys
 from argparse import ArgumentParser
-from os import environ, getcwd, listdir, remove
-from os.path import abspath, isdir, isfile, join, split
-from shutil import which
-from subprocess import DEVNULL, CalledProcessError, check_call, run
+from itertools import islice
+from os import X_OK, access, defpath, environ, getcwd, pathsep, remove, scandir, sep
+from os.path import abspath, expanduser, isdir, isfile, join, realpath
 from sys import stderr
-
-with contextlib.suppress(ModuleNotFoundError):
-    import yaml
+from types import MappingProxyType
 
 ##########################
 ##### Some Constants #####
@@ -22,37 +19,75 @@ VENV_TYPE = "venv"
 POETRY_TYPE = "poetry"
 LINKED_TYPE = "linked"
 
-SUPPORTED_ENVIRONMENT_TYPES = [CONDA_TYPE, VENV_TYPE, POETRY_TYPE]
+SUPPORTED_ENVIRONMENT_TYPES = frozenset((CONDA_TYPE, VENV_TYPE, POETRY_TYPE))
 
 LINKED_ENV_FILES = [".linked_env"]
 POETRY_FILES = ["poetry.lock", "pyproject.toml"]
 VENV_FILES = ["venv", ".venv"]
 CONDA_FILES = ["environment.yaml", "environment.yml"]
 
-TYPE_TO_FILES = {
-    LINKED_TYPE: LINKED_ENV_FILES,
-    POETRY_TYPE: POETRY_FILES,
-    VENV_TYPE: VENV_FILES,
-    CONDA_TYPE: CONDA_FILES,
-}
-
-FILE_TO_TYPE = {
-    environment_file: type_
-    for type_, environment_files_list in TYPE_TO_FILES.items()
-    for environment_file in environment_files_list
-}
+# read-only views, these are not meant to be changed at runtime
+TYPE_TO_FILES = MappingProxyType(
+    {
+        LINKED_TYPE: LINKED_ENV_FILES,
+        POETRY_TYPE: POETRY_FILES,
+        VENV_TYPE: VENV_FILES,
+        CONDA_TYPE: CONDA_FILES,
+    },
+)
+
+FILE_TO_TYPE = MappingProxyType(
+    {
+        environment_file: type_
+        for type_, environment_files_list in TYPE_TO_FILES.items()
+        for environment_file in environment_files_list
+    },
+)
+
+DEFAULT_PRIORITY = (CONDA_TYPE, LINKED_TYPE, POETRY_TYPE, VENV_TYPE)
+
+# (file, type) pairs to look for, ordered by `DEFAULT_PRIORITY`
+PRIORITY_FILES = tuple(
+    (environment_file, FILE_TO_TYPE[environment_file])
+    for type_ in DEFAULT_PRIORITY
+    for environment_file in TYPE_TO_FILES[type_]
+)
 
 # conda env names are not allowed to contain: "/", " ", ":", "#"
 # see: https://github.com/conda/conda/blob/e23cd61c12a68149ab9387baea5fb9b4f34b40aa/conda/base/context.py#L1767-L1772
 YAML_ENV_NAME_REGEX = re.compile(r"^\s*name:\s*([^\/\s:#]*)")
+# only top-level keys, indented `name:` keys belong to nested mappings
+YAML_TOP_LEVEL_ENV_NAME_REGEX = re.compile(r"^name:\s*([^\/\s:#]*)")
+# number of lines to scan for the env name before falling back to a full YAML parse
+YAML_ENV_NAME_MAX_LINES = 32
+YAML_QUOTES = "\"'"
 
 RED = "\033[0;31m"
 GREEN = "\033[0;32m"
 GRAY = "\033[1;30m"
 NC = "\033[0m"
 
+# message parts are built once instead of on each printed message
+MESSAGE_PREFIX = f"{GRAY}\n[ZSH Activate Python Environment]:\n"
+COLOR_TO_MESSAGE_START = {color: f"{color}---> " for color in (RED, GREEN, GRAY)}
+FLUSH_TO_MESSAGE_END = {True: f"{NC}\n\n", False: f"{NC}\n"}
+
 IS_FIRST_MESSAGE = True
 
+# directory -> its entries by name, filled lazily while searching for environment files
+DIRECTORY_CONTENT_CACHE = {}
+
+PATH_DIRECTORIES = environ.get("PATH", defpath).split(pathsep)
+
+# command -> whether it is available on `PATH`
+DEPENDENCY_CACHE = {}
+
+# resolve symlinks, the searched directories come from `getcwd` which resolves them as well
+HOME_DIRECTORY = realpath(expanduser("~"))
+
+# searching for environment files stops at project roots
+PROJECT_ROOT_MARKERS = (".git",)
+
 ##########################
 ##### Main Functions #####
 
@@ -92,26 +127,29 @@ def main():
 
 
 def activate():
-    type_and_environment_file = __find_nearest_environment_file()
+    type_environment_file_and_is_file = __find_nearest_environment_file()
 
-    if type_and_environment_file:
-        __handle_environment_file(type_and_environment_file[0], type_and_environment_file[1])
+    if type_environment_file_and_is_file:
+        __handle_environment_file(*type_environment_file_and_is_file)
 
 
 def deactivate():
-    conda_environment_name = environ.get("CONDA_DEFAULT_ENV", "")
-
-    if environ.get("VIRTUAL_ENV", ""):
+    # the plugin's `deactivate_py_environment` mirrors this in zsh, both need to stay in sync!
+    if environ.get("VIRTUAL_ENV"):
         __return_command("deactivate")
+        return
+
+    conda_environment_name = environ.get("CONDA_DEFAULT_ENV")
 
     # Do not deactivate conda base environment.
     # TODO(se-jaeger): expose possibility to change this
-    elif conda_environment_name and conda_environment_name != "base":
+    if conda_environment_name and conda_environment_name != "base":
         __return_command("conda deactivate")
 
 
 def link(environment_type, name_or_path):
-    if any(linked_env_file in listdir() for linked_env_file in LINKED_ENV_FILES):
+    directory_content = __get_directory_content(getcwd())
+    if any(linked_env_file in directory_content for linked_env_file in LINKED_ENV_FILES):
         __print_error_and_fail(
             "This directory is already linked! You can remove this by using 'unlink_py_environment'",
             error_code=errno.EEXIST,
@@ -129,7 +167,10 @@ def link(environment_type, name_or_path):
 
 
 def unlink():
-    linked_files_in_working_directory = [file for file in LINKED_ENV_FILES if isfile(file)]
+    with scandir() as entries:
+        linked_files_in_working_directory = [
+            entry.name for entry in entries if entry.name in LINKED_ENV_FILES and entry.is_file()
+        ]
 
     if linked_files_in_working_directory:
         for file in linked_files_in_working_directory:
@@ -151,11 +192,8 @@ def unlink():
 def __print_information(message, flush, color=GRAY):
     global IS_FIRST_MESSAGE
 
-    message_prefix = (f"{GRAY}" + "\n[ZSH Activate Python Environment]:\n") if IS_FIRST_MESSAGE else ""
-    after_newline = "\n" if flush else ""
-    msg = f"{message_prefix}{color}---> {message}{NC}{after_newline}"
-
-    print(msg, file=stderr)  # noqa: T201
+    message_prefix = MESSAGE_PREFIX if IS_FIRST_MESSAGE else ""
+    stderr.write(message_prefix + COLOR_TO_MESSAGE_START[color] + message + FLUSH_TO_MESSAGE_END[flush])
     IS_FIRST_MESSAGE = False
 
 
@@ -172,19 +210,37 @@ def __return_command(shell_command):
     print(shell_command)  # noqa: T201
 
 
+def __get_directory_content(directory):
+    directory_content = DIRECTORY_CONTENT_CACHE.get(directory)
+
+    if directory_content is None:
+        with scandir(directory) as entries:
+            directory_content = {entry.name: entry for entry in entries}
+        DIRECTORY_CONTENT_CACHE[directory] = directory_content
+
+    return directory_content
+
+
 def __find_nearest_environment_file(directory=None, priority=None):
     if directory is None:
         directory = getcwd()
 
     if priority is None:
-        priority = [CONDA_TYPE, LINKED_TYPE, POETRY_TYPE, VENV_TYPE]
+        priority_files = PRIORITY_FILES
 
-    if any(environment_type not in TYPE_TO_FILES for environment_type in priority) or any(
-        not isinstance(environment_type, str) for environment_type in priority
-    ):
-        __print_error_and_fail(
-            f"Only the following environment types (given as `str`) are supported! - {', '.join(TYPE_TO_FILES.keys())}",
-            error_code=errno.EINVAL,
+    else:
+        # all keys are `str`, so this also ensures the given types are `str`
+        if not frozenset(priority).issubset(TYPE_TO_FILES.keys()):
+            __print_error_and_fail(
+                "Only the following environment types (given as `str`) are supported! - "
+                + ", ".join(TYPE_TO_FILES.keys()),
+                error_code=errno.EINVAL,
+            )
+
+        priority_files = tuple(
+            (environment_file, FILE_TO_TYPE[environment_file])
+            for type_ in priority
+            for environment_file in TYPE_TO_FILES[type_]
         )
 
     if not isdir(directory):
@@ -193,17 +249,24 @@ def __find_nearest_environment_file(directory=None, priority=None):
             error_code=errno.EINVAL,
         )
 
-    directory_content = listdir(directory)
+    # normalize once and walk up the tree by slicing its components
+    directory_parts = abspath(directory).rstrip(sep).split(sep)
 
-    # iterate over list of lists that contain the actual files to look for
-    for environment_files_list in [TYPE_TO_FILES[type_] for type_ in priority]:
-        for environment_file in environment_files_list:
-            if environment_file in directory_content:
-                return FILE_TO_TYPE[environment_file], join(directory, environment_file)
+    for depth in range(len(directory_parts), 0, -1):
+        current_directory = sep.join(directory_parts[:depth]) or sep
+        directory_content = __get_directory_content(current_directory)
 
-    parent_directory, not_root_directory = split(directory)
-    if not_root_directory:
-        return __find_nearest_environment_file(directory=parent_directory, priority=priority)
+        for environment_file, environment_type in priority_files:
+            entry = directory_content.get(environment_file)
+            if entry is not None:
+                # `DirEntry` already knows its type, no need to `stat` it again later
+                return environment_type, join(current_directory, environment_file), entry.is_file()
+
+        # environment files virtually never live above the home directory or a project's root
+        if current_directory == HOME_DIRECTORY or any(
+            project_root_marker in directory_content for project_root_marker in PROJECT_ROOT_MARKERS
+        ):
+            return None
 
     return None
 
@@ -211,14 +274,44 @@ def __find_nearest_environment_file(directory=None, priority=None):
 def __parse_conda_env_file_and_get_name(environment_file):
     try:
         with open(environment_file) as file:
-            if "yaml" in sys.modules:
-                env = yaml.safe_load(file)
+            # `name` is usually one of the first keys, so we try to avoid parsing the whole YAML document
+            match_top_level_env_name = YAML_TOP_LEVEL_ENV_NAME_REGEX.match
+            for line in islice(file, YAML_ENV_NAME_MAX_LINES):
+                match = match_top_level_env_name(line)
+                if match:
+                    env_name = match.group(1)
+
+                    # quoted or empty names are left to the YAML parser
+                    if env_name and env_name[0] not in YAML_QUOTES:
+                        return env_name
+                    break
+
+            # `yaml` is imported lazily, most calls never need it
+            with contextlib.suppress(ModuleNotFoundError):
+                import yaml  # noqa: PLC0415
+
+                # prefer the libyaml backed loader, it is much faster than the pure python one
+                try:
+                    from yaml import CSafeLoader as YamlLoader  # noqa: PLC0415
+                except ImportError:
+                    from yaml import SafeLoader as YamlLoader  # noqa: PLC0415
+
+                file.seek(0)
+                env = yaml.load(file, Loader=YamlLoader)
+                if not env["name"]:
+                    # jump to `except` block
+                    raise ValueError
                 return env["name"]
 
+            match_env_name = YAML_ENV_NAME_REGEX.match
+
+            file.seek(0)
             for line in file:
-                match = re.match(YAML_ENV_NAME_REGEX, line)
+                match = match_env_name(line)
                 if match:
-                    return match.group(1)
+                    env_name = match.group(1).strip(YAML_QUOTES)
+                    if env_name:
+                        return env_name
 
             # jump to `except` block
             raise Exception
@@ -231,15 +324,21 @@ def __parse_conda_env_file_and_get_name(environment_file):
 
 
 def __parse_linked_environment_file(linked_environment_file):
-    if not isfile(linked_environment_file):
+    # open directly instead of checking `isfile` first, this saves a `stat`
+    try:
+        with open(linked_environment_file, "rb") as file:
+            linked_environment_file_content = file.read()
+
+    except OSError:
         __print_error_and_fail(
             f"Found linked environment file is not a file. Check: {linked_environment_file}",
             error_code=errno.ENOENT,
         )
 
     try:
-        with open(linked_environment_file) as file:
-            environment_type, environment_path_or_name = file.read().split(";")
+        environment_type, environment_path_or_name = (
+            part.decode() for part in linked_environment_file_content.split(b";")
+        )
 
     except:
         __print_error_and_fail(
@@ -257,8 +356,21 @@ def __parse_linked_environment_file(linked_environment_file):
     return environment_type.strip(), environment_path_or_name.strip()
 
 
+def __is_executable_on_path(command):
+    # minimal POSIX-only `shutil.which`
+    for path_directory in PATH_DIRECTORIES:
+        executable = join(path_directory, command)
+        if isfile(executable) and access(executable, X_OK):
+            return True
+
+    return False
+
+
 def __check_dependencies(command):
-    if which(command):
+    if command not in DEPENDENCY_CACHE:
+        DEPENDENCY_CACHE[command] = __is_executable_on_path(command)
+
+    if DEPENDENCY_CACHE[command]:
         return True
 
     __print_information(
@@ -272,7 +384,7 @@ def __print_activation_message(environment_type):
     __print_information(f"Try to activate '{environment_type}' environment ... 🐍🐍", flush=True)
 
 
-def __handle_environment_file(type_, environment_path_file_or_name):
+def __handle_environment_file(type_, environment_path_file_or_name, is_file=None):
     if type_ == LINKED_TYPE:
         # either path to poetry/virtualenv or conda environment name.
         environment_type, environment_path_or_name = __parse_linked_environment_file(environment_path_file_or_name)
@@ -280,6 +392,8 @@ def __handle_environment_file(type_, environment_path_file_or_name):
 
     elif type_ == POETRY_TYPE:
         if __check_dependencies(POETRY_TYPE):
+            from subprocess import DEVNULL, CalledProcessError, check_call, run  # noqa: PLC0415
+
             # check if a virtualenv has been created
             command = "poetry env info --path"
             try:
@@ -297,8 +411,11 @@ def __handle_environment_file(type_, environment_path_file_or_name):
 
     elif type_ == CONDA_TYPE:
         if __check_dependencies(CONDA_TYPE):
+            if is_file is None:
+                is_file = isfile(environment_path_file_or_name)
+
             # It is env file, we parse it to get env name
-            if isfile(environment_path_file_or_name):
+            if is_file:
                 environment_path_file_or_name = __parse_conda_env_file_and_get_name(environment_path_file_or_name)
 
             __return_command(f"conda activate {environment_path_file_or_name}")